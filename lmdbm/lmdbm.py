@@ -1,22 +1,49 @@
+import ctypes
+import functools
+import gzip
 import logging
+import os
+import sys
 from collections.abc import Mapping, MutableMapping
-import gzip
+from concurrent.futures import Future
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Any, Generic, Iterator, List, Optional, Tuple, TypeVar, Union, Callable
-from threading import Lock
+from itertools import islice
+from operator import itemgetter
+from typing import Any, Generic, Iterable, Iterator, List, Optional, Tuple, TypeVar, Union, Callable
+from queue import Empty, Queue
+from threading import Condition, Lock, Thread, local
 import json
+import zlib
 
 import lmdb
 from typing_extensions import Self
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 GenericT = TypeVar("GenericT")
 KeyT = TypeVar("KeyT")
 ValueT = TypeVar("ValueT")
 
 _DEFAULT = object()
+_STOP = object()
 
 text_encoding = "utf8"
 
+writeflags_presets = {
+    "safe": {},
+    "fast": {"metasync": False},
+    "unsafe": {"sync": False, "writemap": True, "map_async": True},
+}
+
 
 class Error(Exception):
     pass
@@ -54,7 +81,27 @@ def remove_lmdbm(path: str, missing_ok: bool = True) -> None:
         base.rmdir()
 
 
+def _identity(value):
+    return value
+
+
+def encode_text(value: str) -> bytes:
+    return value.encode(text_encoding)
+
+
+_TO_BYTES = {str: encode_text, bytearray: bytes, memoryview: bytes}
+
+
 def to_bytes(value):
+    # exact type checks first, they are faster than `isinstance`
+    if type(value) is bytes:
+        return value
+
+    func = _TO_BYTES.get(type(value))
+    if func is not None:
+        return func(value)
+
+    # subclasses
     if isinstance(value, bytes):
         return value
     elif isinstance(value, str):
@@ -63,6 +110,131 @@ def to_bytes(value):
     raise TypeError(value)
 
 
+MADV_NORMAL = 0
+MADV_RANDOM = 1
+MADV_SEQUENTIAL = 2
+MADV_WILLNEED = 3
+
+libc = None
+if sys.platform.startswith("linux"):
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.madvise.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]
+    except (OSError, AttributeError):
+        libc = None
+
+
+def mapped_regions(path: Path) -> List[Tuple[int, int]]:
+    """Returns the (address, length) pairs of all memory mappings of `path` in the current process. Linux only."""
+
+    target = os.path.realpath(path)
+    regions = []
+    for line in Path("/proc/self/maps").read_text().splitlines():
+        parts = line.split(maxsplit=5)
+        if len(parts) == 6 and parts[5] == target:
+            start, end = parts[0].split("-")
+            regions.append((int(start, 16), int(end, 16) - int(start, 16)))
+    return regions
+
+
+def total_memory() -> Optional[int]:
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def allocated_size(path: Path) -> int:
+    # with writemap=True LMDB extends the file to the map size, so the apparent size can be much larger
+    # than the data actually stored. use the allocated blocks where they are available.
+    stat = path.stat()
+    try:
+        return stat.st_blocks * 512
+    except AttributeError:  # Windows
+        return stat.st_size
+
+
+def data_file(path: str, subdir: bool = True) -> Path:
+    if subdir:
+        return Path(path) / "data.mdb"
+    return Path(path)
+
+
+def json_codec(jsonlib: str = "stdlib") -> Tuple[Callable, Callable]:
+    """Returns dumps and loads functions which convert between Python objects and utf-8 encoded json.
+    `jsonlib`: stdlib (default) or orjson. orjson is faster, but doesn't encode everything like json does:
+        NaN and Infinity are stored as null and integers larger than 64 bit raise a TypeError.
+    """
+
+    if jsonlib == "orjson":
+        if orjson is None:
+            raise ImportError("jsonlib='orjson' requires the `orjson` package")
+        # orjson already returns utf-8 bytes
+        return functools.partial(orjson.dumps, option=orjson.OPT_NON_STR_KEYS), orjson.loads
+    elif jsonlib == "stdlib":
+
+        def dumps(value) -> bytes:
+            return json.dumps(value, separators=(",", ":")).encode(text_encoding)
+
+        return dumps, json.loads
+    else:
+        raise ValueError("Invalid jsonlib")
+
+
+def gzip_codec() -> Tuple[Callable, Callable]:
+    """Returns gzip compatible compress and decompress functions which use zlib directly
+    instead of the `GzipFile` based `gzip.compress` and `gzip.decompress`.
+    """
+
+    # compressobj.copy() is locked internally, so the templates can be shared between threads
+    templates = {}
+
+    def compress(data, level: int) -> bytes:
+        template = templates.get(level)
+        if template is None:
+            template = templates[level] = zlib.compressobj(level, zlib.DEFLATED, 31)
+        cobj = template.copy()
+        return cobj.compress(data) + cobj.flush()
+
+    def decompress(data) -> bytes:
+        dobj = zlib.decompressobj(31)
+        out = dobj.decompress(data)
+        # multiple members or a truncated stream. `gzip.decompress` reads all members and raises on errors
+        if dobj.unused_data or not dobj.eof:
+            return gzip.decompress(data)
+        return out
+
+    return compress, decompress
+
+
+def zstd_codec() -> Tuple[Callable, Callable]:
+    """Returns compress and decompress functions which reuse one zstd context per thread
+    (contexts are not thread-safe) instead of creating a new one for every call.
+    """
+
+    if zstandard is None:
+        raise ImportError("zstd compression requires the `zstandard` package")
+
+    contexts = local()
+
+    def compress(data, level: int) -> bytes:
+        cctxs = getattr(contexts, "cctxs", None)
+        if cctxs is None:
+            cctxs = contexts.cctxs = {}
+        cctx = cctxs.get(level)
+        if cctx is None:
+            cctx = cctxs[level] = zstandard.ZstdCompressor(level=level)
+        return cctx.compress(data)
+
+    def decompress(data) -> bytes:
+        dctx = getattr(contexts, "dctx", None)
+        if dctx is None:
+            dctx = contexts.dctx = zstandard.ZstdDecompressor()
+        return dctx.decompress(data)
+
+    return compress, decompress
+
+
 def split_kwargs(keys, kwargs):
     found = {}
     other = {}
@@ -79,11 +251,30 @@ def split_kwargs(keys, kwargs):
 class Lmdb(MutableMapping, Generic[KeyT, ValueT]):
     autogrow_error = "Failed to grow LMDB ({}). Is there enough disk space available?"
     autogrow_msg = "Grew database (%s) map size to %s"
-
-    def __init__(self, env: lmdb.Environment, autogrow: bool = True, logger: Callable = None, **kwargs) -> None:
+    # number of rows after which iterators advise the kernel that the scan is sequential
+    sequential_advice_rows = 1000
+
+    def __init__(
+        self,
+        env: lmdb.Environment,
+        autogrow: bool = True,
+        logger: Callable = None,
+        txn_reuse: int = 0,
+        buffers: bool = False,
+        **kwargs,
+    ) -> None:
         self.env = env
         self.autogrow = autogrow
         self.logger = logger
+        self.txn_reuse = txn_reuse
+        self.buffers = buffers
+        self._regions: Optional[Tuple[int, List[Tuple[int, int]]]] = None
+        self._advice_lock = Lock()
+        self._sequential_scans = 0
+        self._tls = local()
+        self._generation = 0
+        self._buffer: Optional[List[Tuple[bytes, bytes]]] = None
+        self._buffer_limit = 0
 
     @classmethod
     def open(
@@ -92,6 +283,8 @@ class Lmdb(MutableMapping, Generic[KeyT, ValueT]):
         flag: str = "r",
         mode: int = 0o755,
         map_size: int = 2**20,
+        writeflags: str = "safe",
+        readahead_ratio: Optional[float] = 0.5,
         **kwargs,
     ) -> "Lmdb":
         """
@@ -107,9 +300,22 @@ class Lmdb(MutableMapping, Generic[KeyT, ValueT]):
         `path`: Location of directory (if subdir=True) or file prefix to store the database.
         `mode`: File creation mode.
         `logger`: Function used for logging.
+        `txn_reuse`: Number of `__getitem__` and `__contains__` calls served by a single cached read transaction before it's renewed.
+                Writes through this instance renew it immediately, but writes by other processes are not visible until it's renewed.
+                Each thread caches its own transaction. Defaults to 0, which disables the cache.
+                WARNING: A cached transaction is only released by the next read of the same thread or by `close()`.
+                Until then it pins its snapshot, so LMDB can't reuse the pages freed by later writes and the file keeps growing.
+                Avoid it for threads which read once and then stay idle, like the workers of a mostly idle thread pool.
+        `buffers`: If True, reads pass memoryviews into the memory map to `_post_key` and `_post_value` instead of copying them to bytes first.
+                The memoryviews are only valid until these methods return. The default implementations convert them to bytes.
         `map_size`: Maximum size database may grow to; used to size the memory mapping. Defaults to 2**20 (1MB). If database grows larger than map_size, an exception will be raised and the user must close and reopen Environment. On 64-bit there is no penalty for making this huge (say 1TB). Must be <2GB on 32-bit.
             Note
             The default map size is set low to encourage a crash, so users can figure out a good value before learning about this option too late.
+        `writeflags`: Preset for the write path flags `sync`, `metasync`, `writemap` and `map_async`. Explicitly passed flags take precedence.
+            safe: LMDB defaults, every commit is flushed to disk.
+            fast: metasync=False. Keeps database integrity, but a system crash may undo the last committed transaction.
+            unsafe: sync=False, writemap=True, map_async=True. Commits don't wait for the disk, which makes writes several times faster,
+                but a system crash can corrupt the database or lose the last transactions unless `sync()` was called.
         `subdir`: If True, path refers to a subdirectory to store the data and lock files in, otherwise it refers to a filename prefix.
         `metasync`: If False, flush system buffers to disk only once per transaction, omit the metadata flush. Defer that until the system flushes files to disk, or next commit or sync().
             This optimization maintains database integrity, but a system crash may undo the last committed transaction. I.e. it preserves the ACI (atomicity, consistency, isolation) but not D (durability) database property.
@@ -117,6 +323,8 @@ class Lmdb(MutableMapping, Generic[KeyT, ValueT]):
             The risk is governed by how often the system flushes dirty buffers to disk and how often sync() is called. However, if the filesystem preserves write order and writemap=False, transactions exhibit ACI (atomicity, consistency, isolation) properties and only lose D (durability). I.e. database integrity is maintained, but a system crash may undo the final transactions.
             Note that sync=False, writemap=True leaves the system with no hint for when to write transactions to disk, unless sync() is called. map_async=True, writemap=True may be preferable.
         `readahead`: If False, LMDB will disable the OS filesystem readahead mechanism, which may improve random read performance when a database is larger than RAM.
+        `readahead_ratio`: If `readahead` is not given, it's set to False when the database file is larger than this fraction of the physical memory.
+            None disables the check. Memory size is only available on POSIX systems.
         `writemap`: If True, use a writeable memory map unless readonly=True. This is faster and uses fewer mallocs, but loses protection from application bugs like wild pointer writes and other bad updates into the database. Incompatible with nested transactions.
             Processes with and without writemap on the same environment do not cooperate well.
         `meminit`: If False LMDB will not zero-initialize buffers prior to writing them to disk. This improves performance but may cause old heap data to be written saved in the unused portion of the buffer. Do not use this option if your application manipulates confidential data (e.g. plaintext passwords) in memory. This option is only meaningful when writemap=False; new pages are always zero-initialized when writemap=True.
@@ -142,6 +350,24 @@ class Lmdb(MutableMapping, Generic[KeyT, ValueT]):
             kwargs,
         )
 
+        try:
+            preset = writeflags_presets[writeflags]
+        except KeyError:
+            raise ValueError("Invalid writeflags") from None
+        for k, v in preset.items():
+            settings.setdefault(k, v)
+
+        # "n" always starts with an empty database
+        if readahead_ratio is not None and "readahead" not in settings and flag != "n":
+            ram = total_memory()
+            if ram is not None:
+                try:
+                    size = allocated_size(data_file(path, settings.get("subdir", True)))
+                except OSError:
+                    size = 0
+                if size > ram * readahead_ratio:
+                    settings["readahead"] = False
+
         if flag == "r":  # Open existing database for reading only (default)
             env = lmdb.open(path, map_size=map_size, max_dbs=1, readonly=True, create=False, mode=mode, **settings)
         elif flag == "w":  # Open existing database for reading and writing
@@ -163,68 +389,257 @@ class Lmdb(MutableMapping, Generic[KeyT, ValueT]):
 
     @map_size.setter
     def map_size(self, value: int) -> None:
+        self._reset_read_txn()
         self.env.set_mapsize(value)
 
+    def _resize(self, new_map_size: int) -> None:
+        self.map_size = new_map_size
+        if self.logger is not None:
+            self.logger("{} {} {}".format(self.autogrow_msg, self.env.path(), new_map_size))
+
+    def _required_map_size(self, pairs: List[Tuple[bytes, bytes]]) -> int:
+        # used pages plus twice the payload as allowance for the tree overhead, rounded up to a power of two
+        used = (self.env.info()["last_pgno"] + 1) * self.env.stat()["psize"]
+        needed = used + 2 * sum(len(k) + len(v) for k, v in pairs)
+        return 1 << (needed - 1).bit_length()
+
+    def _reserve(self, pairs: List[Tuple[bytes, bytes]]) -> None:
+        # grow the map once before writing `pairs`, instead of aborting and retrying the transaction
+        # for every doubling of the map size
+        if self.autogrow:
+            new_map_size = self._required_map_size(pairs)
+            if new_map_size > self.map_size:
+                self._resize(new_map_size)
+
+    def _grow(self, pairs: Optional[List[Tuple[bytes, bytes]]] = None) -> None:
+        if not self.autogrow:
+            raise SizeError("Map size exceeded")
+        new_map_size = self.map_size * 2
+        if pairs:
+            new_map_size = max(new_map_size, self._required_map_size(pairs))
+        self._resize(new_map_size)
+
+    def _data_file(self) -> Path:
+        return data_file(self.env.path(), self.env.flags()["subdir"])
+
+    def _mapped_regions(self) -> List[Tuple[int, int]]:
+        # parsing /proc/self/maps is slow, so the regions are cached until the map is resized
+        map_size = self.map_size
+        if self._regions is None or self._regions[0] != map_size:
+            try:
+                regions = mapped_regions(self._data_file())
+            except OSError:
+                regions = []
+            self._regions = (map_size, regions)
+        return self._regions[1]
+
+    def _madvise(self, advice: int) -> bool:
+        # gives the kernel `advice` about LMDB's memory map. returns False if that's not possible (not on Linux).
+        if libc is None:
+            return False
+
+        regions = self._mapped_regions()
+        for addr, length in regions:
+            libc.madvise(addr, length, advice)
+        return bool(regions)
+
+    def _sequential(self, it: Iterator[GenericT]) -> Iterator[GenericT]:
+        # iterators read the leaf pages in order. once a scan turns out to be long, ask for aggressive readahead
+        # while it runs. short scans like `next(iter(db))` skip the hint.
+        yield from islice(it, self.sequential_advice_rows)
+        row = next(it, _DEFAULT)
+        if row is _DEFAULT:
+            return
+
+        self._begin_sequential()
+        try:
+            yield row
+            yield from it
+        finally:
+            self._end_sequential()
+
+    def _begin_sequential(self) -> None:
+        with self._advice_lock:
+            self._sequential_scans += 1
+            if self._sequential_scans == 1:
+                self._madvise(MADV_SEQUENTIAL)
+
+    def _end_sequential(self) -> None:
+        # only the last active scan restores the advice LMDB set on open,
+        # which is MADV_RANDOM if readahead is disabled.
+        with self._advice_lock:
+            self._sequential_scans -= 1
+            if self._sequential_scans == 0:
+                try:
+                    self._madvise(MADV_NORMAL if self.env.flags()["readahead"] else MADV_RANDOM)
+                except lmdb.Error:
+                    pass  # abandoned iterators can be finalized after the environment was closed
+
+    def prefetch(self) -> None:
+        """Asks the OS to start reading the database file into the page cache in the background.
+        Call it before iterating over large parts of the database.
+        Uses `madvise(MADV_WILLNEED)` on the memory map on Linux and `posix_fadvise` on other POSIX systems.
+        Does nothing where neither is available (eg. Windows).
+        """
+
+        if self._madvise(MADV_WILLNEED) or not hasattr(os, "posix_fadvise"):
+            return
+
+        fd = os.open(self._data_file(), os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+    def _get_read_txn(self) -> lmdb.Transaction:
+        tls = self._tls
+        txn = getattr(tls, "txn", None)
+        if txn is None or tls.generation != self._generation or tls.ops >= self.txn_reuse:
+            if txn is not None:
+                txn.abort()
+            txn = tls.txn = self.env.begin(buffers=self.buffers)
+            tls.generation = self._generation
+            tls.ops = 0
+        tls.ops += 1
+        return txn
+
+    def _reset_read_txn(self) -> None:
+        # invalidates the cached read transactions of all threads.
+        # the one of the current thread is aborted right away, the others on their next read.
+        # `env.close()` aborts all remaining ones.
+        self._generation += 1
+        txn = getattr(self._tls, "txn", None)
+        if txn is not None:
+            txn.abort()
+            self._tls.txn = None
+
     def _pre_key(self, key: KeyT) -> bytes:
         return to_bytes(key)
 
     def _post_key(self, key: bytes) -> KeyT:
+        if type(key) is memoryview:
+            return bytes(key)
         return key
 
     def _pre_value(self, value: ValueT) -> bytes:
         return to_bytes(value)
 
     def _post_value(self, value: bytes) -> ValueT:
+        if type(value) is memoryview:
+            return bytes(value)
         return value
 
     def __getitem__(self, key: KeyT) -> ValueT:
-        with self.env.begin() as txn:
-            value = txn.get(self._pre_key(key))
-        if value is None:
-            raise KeyError(key)
-        return self._post_value(value)
+        if self.txn_reuse:
+            value = self._get_read_txn().get(self._pre_key(key))
+            if value is not None:
+                return self._post_value(value)
+        else:
+            with self.env.begin(buffers=self.buffers) as txn:
+                value = txn.get(self._pre_key(key))
+                if value is not None:
+                    return self._post_value(value)
+        raise KeyError(key)
 
     def __setitem__(self, key: KeyT, value: ValueT) -> None:
         k = self._pre_key(key)
         v = self._pre_value(value)
+        if self._buffer is not None:
+            self._buffer.append((k, v))
+            if len(self._buffer) >= self._buffer_limit:
+                self.flush()
+            return
+
+        self._reset_read_txn()
         for _i in range(12):
             try:
                 with self.env.begin(write=True) as txn:
                     txn.put(k, v)
                     return
             except lmdb.MapFullError:
-                if not self.autogrow:
-                    raise SizeError("Map size exceeded")
-                new_map_size = self.map_size * 2
-                self.map_size = new_map_size
-                if self.logger is not None:
-                    self.logger("{} {} {}".format(self.autogrow_msg, self.env.path(), new_map_size))
+                self._grow([(k, v)])
 
         raise GrowError(self.autogrow_error.format(self.env.path()))
 
     def __delitem__(self, key: KeyT) -> None:
+        if self._buffer:
+            self.flush()
+        self._reset_read_txn()
         with self.env.begin(write=True) as txn:
             txn.delete(self._pre_key(key))
 
+    def _post_funcs(self, buffers: bool) -> Tuple[Optional[Callable], Optional[Callable]]:
+        # returns the functions used by the iterators to convert keys and values, bound to locals there,
+        # or None if they can be yielded as they are. the default methods only copy memoryviews to bytes.
+        cls = type(self)
+        if cls._post_key is Lmdb._post_key:
+            post_key = bytes if buffers else None
+        else:
+            post_key = self._post_key
+        if cls._post_value is Lmdb._post_value:
+            post_value = bytes if buffers else None
+        else:
+            post_value = self._post_value
+        return post_key, post_value
+
     def keys(self) -> Iterator[KeyT]:
+        post_key, _ = self._post_funcs(False)
         with self.env.begin() as txn:
-            for key in txn.cursor().iternext(keys=True, values=False):
-                yield self._post_key(key)
+            it = self._sequential(txn.cursor().iternext(keys=True, values=False))
+            if post_key is None:
+                yield from it
+            else:
+                for key in it:
+                    yield post_key(key)
 
     def items(self) -> Iterator[Tuple[KeyT, ValueT]]:
-        with self.env.begin() as txn:
-            for key, value in txn.cursor().iternext(keys=True, values=True):
-                yield (self._post_key(key), self._post_value(value))
+        post_key, post_value = self._post_funcs(self.buffers)
+        with self.env.begin(buffers=self.buffers) as txn:
+            it = self._sequential(txn.cursor().iternext(keys=True, values=True))
+            if post_key is None and post_value is None:
+                yield from it
+            elif post_key is None:
+                for key, value in it:
+                    yield (key, post_value(value))
+            else:
+                post_value = post_value or _identity
+                for key, value in it:
+                    yield (post_key(key), post_value(value))
 
     def values(self) -> Iterator[ValueT]:
-        with self.env.begin() as txn:
-            for value in txn.cursor().iternext(keys=False, values=True):
-                yield self._post_value(value)
+        _, post_value = self._post_funcs(self.buffers)
+        with self.env.begin(buffers=self.buffers) as txn:
+            it = self._sequential(txn.cursor().iternext(keys=False, values=True))
+            if post_value is None:
+                yield from it
+            else:
+                for value in it:
+                    yield post_value(value)
+
+    def getmulti(
+        self, keys: Iterable[KeyT], default: Optional[GenericT] = None
+    ) -> Iterator[Tuple[KeyT, Union[ValueT, Optional[GenericT]]]]:
+        """Yields `(key, value)` for all `keys` using a single read transaction, or `(key, default)` if `key` is missing.
+        The keys are yielded in database order, so the cursor moves through the tree sequentially.
+        """
+
+        pairs = sorted(((self._pre_key(key), key) for key in keys), key=itemgetter(0))
+        with self.env.begin(buffers=self.buffers) as txn:
+            with txn.cursor() as curs:
+                for k, key in pairs:
+                    if curs.set_key(k):
+                        yield key, self._post_value(curs.value())
+                    else:
+                        yield key, default
 
     def __contains__(self, key: KeyT) -> bool:
-        with self.env.begin() as txn:
-            value = txn.get(self._pre_key(key))
-        return value is not None
+        # positioning a cursor doesn't copy the value like `txn.get()` does
+        if self.txn_reuse:
+            with self._get_read_txn().cursor() as curs:
+                return curs.set_key(self._pre_key(key))
+        with self.env.begin(buffers=True) as txn:
+            with txn.cursor() as curs:
+                return curs.set_key(self._pre_key(key))
 
     def __iter__(self) -> Iterator[KeyT]:
         return self.keys()
@@ -234,59 +649,150 @@ class Lmdb(MutableMapping, Generic[KeyT, ValueT]):
             return txn.stat()["entries"]
 
     def pop(self, key: KeyT, default: Union[ValueT, GenericT] = _DEFAULT) -> Union[ValueT, GenericT]:
+        if self._buffer:
+            self.flush()
+        self._reset_read_txn()
         with self.env.begin(write=True) as txn:
             value = txn.pop(self._pre_key(key))
         if value is None:
             return default
         return self._post_value(value)
 
+    def _iter_pairs(self, __other: Any) -> Iterator[Tuple[bytes, bytes]]:
+        # bind to locals to avoid the attribute lookups per pair,
+        # and skip the method call if the default conversion is used
+        cls = type(self)
+        pre_key = to_bytes if cls._pre_key is Lmdb._pre_key else self._pre_key
+        pre_value = to_bytes if cls._pre_value is Lmdb._pre_value else self._pre_value
+
+        if isinstance(__other, Mapping):
+            for key, value in __other.items():
+                yield pre_key(key), pre_value(value)
+        elif hasattr(__other, "keys"):
+            for key in __other.keys():
+                yield pre_key(key), pre_value(__other[key])
+        else:
+            for key, value in __other:
+                yield pre_key(key), pre_value(value)
+
+    def _sorted_pairs(self, __other: Any) -> List[Tuple[bytes, bytes]]:
+        # the sort is stable, so the last value of duplicate keys is still the one which is stored
+        pairs = list(self._iter_pairs(__other))
+        pairs.sort(key=itemgetter(0))
+        return pairs
+
     def update(self, __other: Any = (), **kwds: ValueT) -> None:  # python3.8 only: update(self, other=(), /, **kwds)
+        """Inserts all pairs of `__other` and `kwds` using a single transaction.
+        Pairs which need to be collected anyway (from iterables or for retries) are sorted by key first,
+        as LMDB inserts sorted keys faster.
+        """
+
+        self._update(__other, kwds, False)
+
+    def update_append(self, __other: Any) -> None:
+        """Appends all pairs of `__other` to the end of the database using a single transaction,
+        without comparing keys. This is faster than `update()` for bulk loading.
+        The caller must make sure the keys are unique, sorted and larger than all existing keys,
+        otherwise `Error` is raised and nothing is inserted.
+        """
+
+        self._update(__other, {}, True)
+
+    def _update(self, __other: Any, kwds: dict, append: bool) -> None:
         # fixme: `kwds`
 
+        if self._buffer:
+            self.flush()
+
         # note: benchmarking showed that there is no real difference between using lists or iterables
         # as input to `putmulti`.
         # lists: Finished 14412594 in 253496 seconds.
         # iter:  Finished 14412594 in 256315 seconds.
 
-        # save generated lists in case the insert fails and needs to be retried
-        # for performance reasons, but mostly because `__other` could be an iterable
-        # which would already be exhausted on the second try
+        # mappings can be iterated again, so their pairs are streamed into `putmulti` on the first try
+        # to avoid holding all of them in memory at once. other iterables could already be exhausted
+        # on the second try, so their pairs are saved in a list beforehand.
+        # the lists are also reused on retries for performance reasons.
         pairs_other: Optional[List[Tuple[bytes, bytes]]] = None
         pairs_kwds: Optional[List[Tuple[bytes, bytes]]] = None
 
+        if not (isinstance(__other, Mapping) or hasattr(__other, "keys")):
+            pairs_other = self._sorted_pairs(__other)
+
+        self._reset_read_txn()
+
+        if pairs_other is not None:
+            self._reserve(pairs_other)
+
         for _i in range(12):
             try:
                 with self.env.begin(write=True) as txn:
                     with txn.cursor() as curs:
-                        if isinstance(__other, Mapping):
-                            pairs_other = pairs_other or [
-                                (self._pre_key(key), self._pre_value(__other[key])) for key in __other
-                            ]
-                            curs.putmulti(pairs_other)
-                        elif hasattr(__other, "keys"):
-                            pairs_other = pairs_other or [
-                                (self._pre_key(key), self._pre_value(__other[key])) for key in __other.keys()
-                            ]
-                            curs.putmulti(pairs_other)
+                        if pairs_other is None:
+                            consumed, added = curs.putmulti(self._iter_pairs(__other), append=append)
                         else:
-                            pairs_other = pairs_other or [
-                                (self._pre_key(key), self._pre_value(value)) for key, value in __other
-                            ]
-                            curs.putmulti(pairs_other)
+                            consumed, added = curs.putmulti(pairs_other, append=append)
+                        if append and added != consumed:
+                            # raising aborts the transaction, so nothing is written
+                            raise Error("update_append() requires unique, sorted keys larger than all existing keys")
 
-                        pairs_kwds = pairs_kwds or [
-                            (self._pre_key(key), self._pre_value(value)) for key, value in kwds.items()
-                        ]
-                        curs.putmulti(pairs_kwds)
+                        if kwds:
+                            pairs_kwds = pairs_kwds or list(self._iter_pairs(kwds))
+                            curs.putmulti(pairs_kwds)
 
                         return
             except lmdb.MapFullError:
                 if not self.autogrow:
                     raise SizeError("Map size exceeded")
-                new_map_size = self.map_size * 2
-                self.map_size = new_map_size
-                if self.logger is not None:
-                    self.logger("{} {} {}".format(self.autogrow_msg, self.env.path(), new_map_size))
+                if pairs_other is None:
+                    pairs_other = self._sorted_pairs(__other)
+                self._grow(pairs_other)
+
+        raise GrowError(self.autogrow_error.format(self.env.path()))
+
+    @contextmanager
+    def batch(self, n: int = 1000) -> Iterator[Self]:
+        """
+        Buffers `__setitem__` calls inside the `with` block and writes them `n` at a time,
+        each batch in a single transaction. The remaining items are written when the block exits normally.
+        If the block raises an exception, the items which are not written yet are discarded.
+        Buffered items are not visible to reads until they are flushed.
+        The buffer is not thread-safe, so don't use the same instance from multiple threads inside the block.
+        """
+
+        if self._buffer is not None:
+            raise Error("batch() cannot be nested")
+        if n < 1:
+            raise ValueError("n must be positive")
+
+        self._buffer = []
+        self._buffer_limit = n
+        try:
+            yield self
+            self.flush()
+        finally:
+            self._buffer = None
+
+    def flush(self) -> None:
+        """Writes the items buffered by `batch()` using a single transaction."""
+
+        if not self._buffer:
+            return
+
+        self._putmulti(self._buffer)
+        self._buffer.clear()
+
+    def _putmulti(self, pairs: List[Tuple[bytes, bytes]]) -> None:
+        self._reset_read_txn()
+        self._reserve(pairs)
+        for _i in range(12):
+            try:
+                with self.env.begin(write=True) as txn:
+                    with txn.cursor() as curs:
+                        curs.putmulti(pairs)
+                return
+            except lmdb.MapFullError:
+                self._grow(pairs)
 
         raise GrowError(self.autogrow_error.format(self.env.path()))
 
@@ -294,6 +800,9 @@ class Lmdb(MutableMapping, Generic[KeyT, ValueT]):
         self.env.sync()
 
     def close(self) -> None:
+        if self._buffer:
+            self.flush()
+        self._reset_read_txn()
         self.env.close()
 
     def __enter__(self) -> Self:
@@ -303,28 +812,296 @@ class Lmdb(MutableMapping, Generic[KeyT, ValueT]):
         self.close()
 
 
+class ReadWriteLock:
+    """Lock which can be held by any number of readers or by a single writer. Waiting writers go first."""
+
+    def __init__(self) -> None:
+        self._cond = Condition()
+        self._readers = 0
+        self._writing = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read(self) -> Iterator[None]:
+        with self._cond:
+            while self._writing or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self) -> Iterator[None]:
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writing or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
+
+
+class _Call:
+    def __init__(self, func: Callable) -> None:
+        self.func = func
+        self.future: Future = Future()
+
+    def run(self) -> None:
+        if self.future.set_running_or_notify_cancel():
+            try:
+                self.future.set_result(self.func())
+            except BaseException as e:
+                self.future.set_exception(e)
+
+
+class AsyncLmdb(Lmdb[KeyT, ValueT]):
+    """
+    Writes the items assigned with `__setitem__` from a background thread, up to `batch_size` per transaction,
+    so the caller doesn't wait for the commit.
+    Reads may not see items which are still queued. `sync()` waits until all of them are written.
+    `__delitem__`, `pop()` and `update()` are run by the background thread as well, to keep the order of writes,
+    and wait for their result.
+    Reads can run concurrently with the writes. Growing the map waits for running reads and blocks new ones meanwhile.
+    Iterators read `batch_size` rows per transaction, so they are not a consistent snapshot of the database.
+    If writing fails, the items of that batch are lost and the error is raised by the next call
+    to `__setitem__`, `sync()` or `close()`. Always call `close()`, otherwise queued items may be lost at exit.
+    `txn_reuse` is not supported, as cached transactions would be open while the map is resized.
+    """
+
+    def __init__(self, env: lmdb.Environment, batch_size: int = 1000, queue_size: int = 10000, **kwargs) -> None:
+        if kwargs.get("txn_reuse"):
+            raise ValueError("txn_reuse is not supported by AsyncLmdb")
+
+        super().__init__(env, **kwargs)
+        self.batch_size = batch_size
+        # LMDB requires that no transactions are active while the map is resized
+        self._resize_lock = ReadWriteLock()
+        self._queue: Queue = Queue(maxsize=queue_size)
+        self._error: Optional[Exception] = None
+        self._thread = Thread(target=self._drain, daemon=True)
+        self._thread.start()
+
+    def _drain(self) -> None:
+        # all writes, and therefore all map resizes, happen on this thread
+        queue = self._queue
+        while True:
+            pairs = []
+            item = queue.get()
+            while type(item) is tuple:
+                pairs.append(item)
+                if len(pairs) >= self.batch_size:
+                    item = None
+                    break
+                try:
+                    item = queue.get_nowait()
+                except Empty:
+                    item = None
+                    break
+
+            if pairs:
+                try:
+                    self._putmulti(pairs)
+                except Exception as e:
+                    self._error = e
+
+            for _i in range(len(pairs)):
+                queue.task_done()
+
+            if item is _STOP:
+                queue.task_done()
+                return
+            elif item is not None:
+                item.run()
+                queue.task_done()
+
+    def _resize(self, new_map_size: int) -> None:
+        with self._resize_lock.write():
+            super()._resize(new_map_size)
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _check_open(self) -> None:
+        # nothing reads the queue anymore once the writer thread stopped
+        self._raise_error()
+        if not self._thread.is_alive():
+            raise lmdb.Error("Attempt to write to a closed AsyncLmdb")
+
+    def _call(self, func: Callable) -> Any:
+        # runs `func` on the writer thread after all queued items are written
+        self._check_open()
+        call = _Call(func)
+        self._queue.put(call)
+        result = call.future.result()
+        self._raise_error()
+        return result
+
+    def __getitem__(self, key: KeyT) -> ValueT:
+        with self._resize_lock.read():
+            return super().__getitem__(key)
+
+    def __setitem__(self, key: KeyT, value: ValueT) -> None:
+        self._check_open()
+        self._queue.put((self._pre_key(key), self._pre_value(value)))
+
+    def __delitem__(self, key: KeyT) -> None:
+        self._call(functools.partial(super().__delitem__, key))
+
+    def __contains__(self, key: KeyT) -> bool:
+        with self._resize_lock.read():
+            return super().__contains__(key)
+
+    def __len__(self) -> int:
+        with self._resize_lock.read():
+            return super().__len__()
+
+    def _scan(self, keys: bool, values: bool) -> Iterator:
+        # a transaction can't stay open across yields, the map couldn't be grown meanwhile.
+        # so the rows are read in chunks and the cursor is positioned after the last key for the next one.
+        buffers = self.buffers and values
+        last: Optional[bytes] = None
+        while True:
+            chunk: list = []
+            with self._resize_lock.read(), self.env.begin(buffers=buffers) as txn:
+                curs = txn.cursor()
+                if last is None:
+                    found = curs.first()
+                else:
+                    found = curs.set_range(last)
+                    if found and curs.key() == last:
+                        found = curs.next()
+
+                while found and len(chunk) < self.batch_size:
+                    key = curs.key()
+                    last = bytes(key)
+                    if not values:
+                        chunk.append(self._post_key(key))
+                    elif not keys:
+                        chunk.append(self._post_value(curs.value()))
+                    else:
+                        chunk.append((self._post_key(key), self._post_value(curs.value())))
+                    found = curs.next()
+
+            yield from chunk
+            if not found:
+                return
+
+    def keys(self) -> Iterator[KeyT]:
+        return self._scan(True, False)
+
+    def items(self) -> Iterator[Tuple[KeyT, ValueT]]:
+        return self._scan(True, True)
+
+    def values(self) -> Iterator[ValueT]:
+        return self._scan(False, True)
+
+    def getmulti(
+        self, keys: Iterable[KeyT], default: Optional[GenericT] = None
+    ) -> Iterator[Tuple[KeyT, Union[ValueT, Optional[GenericT]]]]:
+        with self._resize_lock.read():
+            return iter(list(super().getmulti(keys, default)))
+
+    def pop(self, key: KeyT, default: Union[ValueT, GenericT] = _DEFAULT) -> Union[ValueT, GenericT]:
+        return self._call(functools.partial(super().pop, key, default))
+
+    def update(self, __other: Any = (), **kwds: ValueT) -> None:
+        self._call(functools.partial(super().update, __other, **kwds))
+
+    def update_append(self, __other: Any) -> None:
+        self._call(functools.partial(super().update_append, __other))
+
+    def sync(self) -> None:
+        self._call(super().sync)
+
+    def close(self) -> None:
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+        try:
+            self._raise_error()
+        finally:
+            super().close()
+
+
 def LmdbJson(classtype=Lmdb):
+    return _json_class(classtype)
+
+
+# cached, so every call with the same `classtype` returns the same class.
+# `lru_cache` keys on the way the arguments are passed, so it's only called positionally.
+@functools.lru_cache(maxsize=None)
+def _json_class(classtype):
     class entity(classtype):
+        def __init__(self, env, jsonlib: str = "stdlib", **kwargs):
+            """`jsonlib`: stdlib or orjson. See `json_codec()` for the differences."""
+
+            super().__init__(env, **kwargs)
+            self.jsondumps, self.jsonloads = json_codec(jsonlib)
+
         def _pre_value(self, value):
-            value = json.dumps(value, separators=(",", ":")).encode(text_encoding)
+            value = self.jsondumps(value)
             return super()._pre_value(value)
 
         def _post_value(self, value):
             value = super()._post_value(value)
-            return json.loads(value)
+            return self.jsonloads(value)
 
     return entity
 
 
 def LmdbCompress(classtype=Lmdb):
+    return _compress_class(classtype)
+
+
+@functools.lru_cache(maxsize=None)
+def _compress_class(classtype):
     class entity(classtype):
         def __init__(
-            self, env, compressfunc=gzip.compress, decompressfunc=gzip.decompress, compresslevel: int = 9, **kwargs
+            self,
+            env,
+            compressfunc=None,
+            decompressfunc=None,
+            compresslevel: Optional[int] = None,
+            compression: str = "gzip",
+            buffers: Optional[bool] = None,
+            **kwargs,
         ):
-            super().__init__(env, **kwargs)
-            self.compresslevel = compresslevel
-            self.compressfunc = compressfunc
-            self.decompressfunc = decompressfunc
+            """
+            `compression`: gzip (default, compresslevel 9) or zstd (compresslevel 3, requires `zstandard`).
+                Databases can only be read using the compression they were written with.
+            `compressfunc`, `decompressfunc`: Override the functions selected by `compression`.
+            `buffers`: Defaults to True if the builtin decompression is used, which reads the memoryviews directly,
+                so there is no need to copy them first. A custom `decompressfunc` gets bytes unless it's set to True.
+            """
+
+            if buffers is None:
+                buffers = decompressfunc is None
+            super().__init__(env, buffers=buffers, **kwargs)
+
+            if compression == "gzip":
+                default_compressfunc, default_decompressfunc = gzip_codec()
+                default_compresslevel = 9
+            elif compression == "zstd":
+                default_compressfunc, default_decompressfunc = zstd_codec()
+                default_compresslevel = 3
+            else:
+                raise ValueError("Invalid compression")
+
+            self.compresslevel = default_compresslevel if compresslevel is None else compresslevel
+            self.compressfunc = compressfunc or default_compressfunc
+            self.decompressfunc = decompressfunc or default_decompressfunc
 
         def _pre_value(self, value: ValueT) -> bytes:
             value = self.compressfunc(to_bytes(value), self.compresslevel)
@@ -337,6 +1114,34 @@ def LmdbCompress(classtype=Lmdb):
     return entity
 
 
+def LmdbJsonZstd(classtype=Lmdb):
+    """Same as `[LmdbJson, LmdbCompress]` with `compression="zstd"` and compatible with it,
+    but in a single layer which skips the intermediate conversions. Requires `zstandard`.
+    """
+
+    return _json_zstd_class(classtype)
+
+
+@functools.lru_cache(maxsize=None)
+def _json_zstd_class(classtype):
+    class entity(classtype):
+        def __init__(self, env, jsonlib: str = "stdlib", compresslevel: int = 3, buffers: bool = True, **kwargs):
+            super().__init__(env, buffers=buffers, **kwargs)
+            self.jsondumps, self.jsonloads = json_codec(jsonlib)
+            self.compressfunc, self.decompressfunc = zstd_codec()
+            self.compresslevel = compresslevel
+
+        def _pre_value(self, value):
+            value = self.compressfunc(self.jsondumps(value), self.compresslevel)
+            return super()._pre_value(value)
+
+        def _post_value(self, value):
+            value = super()._post_value(self.decompressfunc(value))
+            return self.jsonloads(value)
+
+    return entity
+
+
 def chain(args):
     assert len(args) > 0
     ret = Lmdb
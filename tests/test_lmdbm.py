@@ -1,11 +1,38 @@
+import gzip
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from threading import Event
 from pathlib import Path
 
 from genutility.test import MyTestCase
 from lmdb import Error
 
-from lmdbm import Lmdb, LmdbCompress, LmdbJson
+from lmdbm import AsyncLmdb, Lmdb, LmdbCompress, LmdbJson, LmdbJsonZstd
 import lmdbm
-from lmdbm.lmdbm import remove_lmdbm
+from lmdbm.lmdbm import orjson, remove_lmdbm, to_bytes, zstandard
+
+
+class ToBytesTests(MyTestCase):
+    def test_to_bytes(self):
+        class Text(str):
+            pass
+
+        self.assertEqual(to_bytes(b"a"), b"a")
+        self.assertEqual(to_bytes("ä"), "ä".encode("utf8"))
+        self.assertEqual(to_bytes(bytearray(b"a")), b"a")
+        self.assertEqual(to_bytes(memoryview(b"a")), b"a")
+        self.assertEqual(to_bytes(Text("a")), b"a")
+        with self.assertRaises(TypeError):
+            to_bytes(1)
+
+
+class ChainTests(MyTestCase):
+    def test_chain_cached(self):
+        for factory in (LmdbJson, LmdbCompress, LmdbJsonZstd):
+            self.assertIs(factory(), factory(Lmdb))
+            self.assertIs(factory(), factory(classtype=Lmdb))
+        self.assertIs(lmdbm.lmdbm.chain([LmdbJson, LmdbCompress]), lmdbm.lmdbm.chain([LmdbJson, LmdbCompress]))
 
 
 class LmdbmTests(MyTestCase):
@@ -54,6 +81,162 @@ class LmdbmTests(MyTestCase):
 
         self._delete_db()
 
+    def test_batch(self):
+        with Lmdb.open(self._name, "n", map_size=1024) as db:
+            with db.batch(n=2):
+                db[b"a"] = b"1"
+                assert b"a" not in db
+                db[b"b"] = b"2" * 1000
+                assert db[b"a"] == b"1"
+                db[b"c"] = b"3"
+                del db[b"b"]
+            assert b"b" not in db
+            assert db[b"c"] == b"3"
+            assert len(db) == 2
+
+            with db.batch():
+                db[b"a"] = b"4"
+                db.update({b"a": b"5"})
+            assert db[b"a"] == b"5"
+
+            with self.assertRaises(RuntimeError):
+                with db.batch():
+                    db[b"d"] = b"6"
+                    raise RuntimeError
+            assert b"d" not in db
+
+        self._delete_db()
+
+    def test_writeflags(self):
+        for writeflags in ("safe", "fast", "unsafe"):
+            with Lmdb.open(self._name, "n", writeflags=writeflags) as db:
+                db[b"a"] = b"1"
+                db.sync()
+                assert db[b"a"] == b"1"
+            self._delete_db()
+
+        with self.assertRaises(ValueError):
+            Lmdb.open(self._name, "n", writeflags="invalid")
+
+    def test_readahead_ratio(self):
+        self._init_db()
+        with Lmdb.open(self._name, "r", readahead_ratio=0.0) as db:
+            if lmdbm.lmdbm.total_memory() is not None:
+                assert not db.env.flags()["readahead"]
+            self.assertUnorderedMappingEqual(db, self._dict)
+
+        self._delete_db()
+
+        # the heuristic needs the memory size. this also skips Windows,
+        # where writemap=True would allocate the whole 1 TB map on disk.
+        if lmdbm.lmdbm.total_memory() is None:
+            return
+
+        with Lmdb.open(self._name, "n", map_size=2**40, writeflags="unsafe") as db:
+            db[b"a"] = b"1"
+        with Lmdb.open(self._name, "r") as db:
+            assert db.env.flags()["readahead"]
+
+        self._delete_db()
+
+    def test_madvise(self):
+        self._init_db()
+        with Lmdb.open(self._name, "r") as db:
+            if lmdbm.lmdbm.libc is not None:
+                assert db._mapped_regions()
+                assert db._mapped_regions() is db._mapped_regions()
+            db.prefetch()
+
+            db.sequential_advice_rows = 2
+            outer = db.keys()
+            self.assertEqual(list(islice(outer, 3)), [b"a", b"b", b"c"])
+            assert db._sequential_scans == 1
+            self.assertEqual(list(db.items()), sorted(self._dict.items()))
+            assert db._sequential_scans == 1
+            self.assertEqual(list(outer), [b"d", b"f", b"g"])
+            assert db._sequential_scans == 0
+            next(iter(db))
+            assert db._sequential_scans == 0
+            self.assertUnorderedMappingEqual(dict(db.items()), self._dict)
+
+        self._delete_db()
+
+    def test_txn_reuse(self):
+        self._init_db()
+        with Lmdb.open(self._name, "w", txn_reuse=2) as db:
+            for _i in range(5):
+                assert db[b"a"] == b"Python:"
+            db[b"a"] = b"Java:"
+            assert db[b"a"] == b"Java:"
+            del db[b"a"]
+            assert b"a" not in db
+            db.update({b"a": b"Rust:"})
+            assert db[b"a"] == b"Rust:"
+
+            with ThreadPoolExecutor(4) as executor:
+                self.assertEqual(list(executor.map(lambda _: db[b"a"], range(20))), [b"Rust:"] * 20)
+                db[b"a"] = b"Go:"
+                self.assertEqual(list(executor.map(lambda _: db[b"a"], range(20))), [b"Go:"] * 20)
+
+        self._delete_db()
+
+    def test_buffers(self):
+        self._init_db()
+        with Lmdb.open(self._name, "r", buffers=True) as db:
+            assert type(db[b"a"]) is bytes
+            assert all(type(k) is bytes and type(v) is bytes for k, v in db.items())
+            self.assertUnorderedMappingEqual(dict(db.items()), self._dict)
+            self.assertEqual(set(db.values()), set(self._dict.values()))
+
+        self._delete_db()
+
+    def test_mem_grow_batch_large(self):
+        value = b"asd" * 1000
+        logs = []
+
+        with Lmdb.open(self._name, "n", map_size=1024, logger=logs.append) as db:
+            db.update((str(i), value) for i in range(1000))
+            assert len(db) == 1000
+            assert len(logs) == 1
+
+        self._delete_db()
+
+    def test_mem_grow_batch_mapping(self):
+        value = b"asd" * 1000
+
+        with Lmdb.open(self._name, "n", map_size=1024) as db:
+            db.update({"key_1": value, "key_2": value})
+            assert db["key_1"] == value
+            assert db["key_2"] == value
+
+        self._delete_db()
+
+    def test_getmulti(self):
+        self._init_db()
+        with Lmdb.open(self._name, "r") as db:
+            truth = [(b"a", b"Python:"), (b"d", b"way"), (b"e", None), (b"g", b"intended")]
+            self.assertEqual(list(db.getmulti([b"g", b"e", b"a", b"d"])), truth)
+            self.assertEqual(dict(db.getmulti(["x"], b"")), {"x": b""})
+
+        self._delete_db()
+
+    def test_update_append(self):
+        with Lmdb.open(self._name, "n") as db:
+            db.update([(b"b", b"1"), (b"a", b"2"), (b"b", b"3")])
+            self.assertEqual(dict(db.items()), {b"a": b"2", b"b": b"3"})
+            db.update(((b"c%d" % i, b"") for i in range(100, 200)))
+            assert len(db) == 102
+            db.update_append(((b"d%d" % i, b"") for i in range(100, 200)))
+            assert len(db) == 202
+            with self.assertRaises(lmdbm.Error):
+                db.update_append([(b"e", b"1"), (b"a", b"3")])
+            assert b"e" not in db
+            assert db[b"a"] == b"2"
+            db.update(append=b"x")
+            assert db[b"append"] == b"x"
+
+        self._delete_db()
+
     def test_missing_read_only(self):
         with self.assertRaises(Error):
             with Lmdb.open(self._name, "r", map_size=1024) as db:
@@ -73,6 +256,89 @@ class LmdbmTests(MyTestCase):
         self._delete_db()
 
 
+class AsyncLmdbTests(MyTestCase):
+    _name = "./test5.db"
+
+    def _delete_db(self):
+        remove_lmdbm(self._name, False)
+
+    def test_write(self):
+        value = b"asd" * 100
+
+        with AsyncLmdb.open(self._name, "n", map_size=1024, batch_size=100) as db:
+            for i in range(250):
+                db[str(i)] = value
+            db.sync()
+            assert len(db) == 250
+            db["0"] = b"x"
+            del db["0"]
+            assert "0" not in db
+            for i in range(250, 500):
+                db[str(i)] = value
+
+        with Lmdb.open(self._name, "r") as db:
+            assert len(db) == 499
+            assert db["499"] == value
+
+        self._delete_db()
+
+    def test_write_after_close(self):
+        db = AsyncLmdb.open(self._name, "n", queue_size=2)
+        db["a"] = b"1"
+        db.close()
+
+        for _i in range(3):
+            with self.assertRaises(Error):
+                db["b"] = b"2"
+        with self.assertRaises(Error):
+            del db["a"]
+        with self.assertRaises(Error):
+            db.update({"c": b"3"})
+        with self.assertRaises(Error):
+            db.sync()
+
+        with Lmdb.open(self._name, "r") as db:
+            assert dict(db.items()) == {b"a": b"1"}
+
+        self._delete_db()
+
+    def test_read_while_growing(self):
+        value = b"x" * 1000
+        errors = []
+
+        with AsyncLmdb.open(self._name, "n", map_size=2**16, batch_size=50) as db:
+            db["seed"] = b"seed"
+            db.sync()
+            map_size = db.env.info()["map_size"]
+            done = Event()
+
+            def read():
+                while not done.is_set():
+                    try:
+                        assert db["seed"] == b"seed"
+                        assert "seed" in db
+                        for k, v in db.items():
+                            pass
+                        list(db.getmulti([b"seed", b"0"]))
+                    except Exception as e:
+                        errors.append(e)
+                        return
+
+            with ThreadPoolExecutor(1) as executor:
+                future = executor.submit(read)
+                for i in range(5000):
+                    db[str(i)] = value
+                db.sync()
+                done.set()
+                future.result()
+
+            assert db.env.info()["map_size"] > map_size
+            assert len(db) == 5001
+
+        assert errors == []
+        self._delete_db()
+
+
 class LmdbmJsonTests(MyTestCase):
     _name = "./test2.db"
 
@@ -100,6 +366,35 @@ class LmdbmJsonTests(MyTestCase):
 
         self._delete_db()
 
+    def test_stdlib_default(self):
+        with lmdbm.open(self._name, "n", classtype=[LmdbJson]) as db:
+            db["a"] = float("inf")
+            db["b"] = 2**70
+            self.assertEqual(db["a"], float("inf"))
+            self.assertEqual(db["b"], 2**70)
+
+        self._delete_db()
+
+    @unittest.skipIf(orjson is None, "orjson not installed")
+    def test_jsonlib(self):
+        with lmdbm.open(self._name, "n", classtype=[LmdbJson], jsonlib="stdlib") as db:
+            db["a"] = {"a": [1, 5], "b": "ü"}
+
+        with lmdbm.open(self._name, "w", classtype=[LmdbJson], jsonlib="orjson") as db:
+            self.assertEqual(db["a"], {"a": [1, 5], "b": "ü"})
+            db["b"] = {1: None}
+
+        with lmdbm.open(self._name, "r", classtype=[LmdbJson], jsonlib="stdlib") as f:
+            self.assertEqual(f["b"], {"1": None})
+
+        with lmdbm.open(self._name, "w", classtype=[LmdbJson], jsonlib="orjson") as db:
+            db["c"] = float("nan")
+            self.assertIsNone(db["c"])
+            with self.assertRaises(TypeError):
+                db["d"] = 2**70
+
+        self._delete_db()
+
 
 class LmdbmCompressTests(MyTestCase):
     _name = "./test3.db"
@@ -118,6 +413,43 @@ class LmdbmCompressTests(MyTestCase):
 
         self._delete_db()
 
+    def test_gzip_compatible(self):
+        with lmdbm.open(self._name, "n", classtype=[LmdbCompress], compressfunc=gzip.compress) as db:
+            db["a"] = "245252895125589252525259"
+
+        with lmdbm.open(self._name, "w", classtype=[LmdbCompress]) as db:
+            self.assertEqual(db["a"], b"245252895125589252525259")
+            db["b"] = "245252895125589252525259"
+
+        def decompress(value):
+            assert type(value) is bytes
+            return gzip.decompress(value)
+
+        with lmdbm.open(self._name, "r", classtype=[LmdbCompress], decompressfunc=decompress) as f:
+            self.assertEqual(f["b"], b"245252895125589252525259")
+            self.assertEqual(dict(f.items())[b"a"], b"245252895125589252525259")
+
+        def compress_members(value, level):
+            return gzip.compress(value[:4], level) + gzip.compress(value[4:], level)
+
+        with lmdbm.open(self._name, "w", classtype=[LmdbCompress], compressfunc=compress_members) as db:
+            db["c"] = "245252895125589252525259"
+            self.assertEqual(db["c"], b"245252895125589252525259")
+
+        self._delete_db()
+
+    @unittest.skipIf(zstandard is None, "zstandard not installed")
+    def test_zstd(self):
+        with lmdbm.open(self._name, "n", classtype=[LmdbCompress], compression="zstd") as db:
+            db["a"] = "245252895125589252525259"
+            db.update({"b": b"x" * 1000})
+
+        with lmdbm.open(self._name, "r", classtype=[LmdbCompress], compression="zstd") as f:
+            self.assertEqual(f["a"], b"245252895125589252525259")
+            self.assertEqual(dict(f.items()), {b"a": b"245252895125589252525259", b"b": b"x" * 1000})
+
+        self._delete_db()
+
 
 class LmdbmJsonCompressTests(MyTestCase):
     _name = "./test4.db"
@@ -147,7 +479,28 @@ class LmdbmJsonCompressTests(MyTestCase):
         self._delete_db()
 
 
-if __name__ == "__main__":
-    import unittest
+@unittest.skipIf(zstandard is None, "zstandard not installed")
+class LmdbmJsonZstdTests(MyTestCase):
+    _name = "./test6.db"
 
+    def _delete_db(self):
+        remove_lmdbm(self._name, False)
+
+    def test_modify(self):
+        with lmdbm.open(self._name, "n", classtype=[LmdbJsonZstd]) as db:
+            db["a"] = 5
+            db["e"] = {"a": 52, "b": 95}
+
+        with lmdbm.open(self._name, "c", classtype=[LmdbJson, LmdbCompress], compression="zstd") as f:
+            self.assertEqual(f["a"], 5)
+            self.assertEqual(f["e"], {"a": 52, "b": 95})
+            f["d"] = [1, 5]
+
+        with lmdbm.open(self._name, "r", classtype=[LmdbJsonZstd]) as f:
+            self.assertEqual(dict(f.items()), {b"a": 5, b"d": [1, 5], b"e": {"a": 52, "b": 95}})
+
+        self._delete_db()
+
+
+if __name__ == "__main__":
     unittest.main()